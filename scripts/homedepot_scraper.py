@@ -1,31 +1,86 @@
 #!/usr/bin/env python3
-"""Scrape Home Depot liquidation deals and save to JSON."""
+"""Scrape Home Depot liquidation deals and stream them to NDJSON and CSV."""
 from __future__ import annotations
 
 import argparse
-import json
 import inspect
+import os
+import random
+import sys
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from pathlib import Path
-from typing import Iterable
+from typing import TYPE_CHECKING, Iterable, Iterator
 
 import csv
 
 import httpx
-from parsel import Selector
+import orjson
+from hishel import SpecificationPolicy, SyncSqliteStorage
+from hishel.httpx import SyncCacheClient
+from lxml import etree
+from parsel import Selector, SelectorList
+from parsel.csstranslator import css2xpath
+
+if TYPE_CHECKING:
+    from playwright.sync_api import Browser, Playwright, Route
 
 BASE_URL = "https://www.homedepot.ca"
 CLEARANCE_URL = "https://www.homedepot.ca/en/home/categories/all/collections/clearance.html"
-OUTPUT_PATH = Path("data/homedepot/liquidations.json")
+OUTPUT_PATH = Path("data/homedepot/liquidations.ndjson")
+CACHE_PATH = Path(".cache/homedepot/http_cache.db")
+# Storage lifetime only; freshness and revalidation follow the response headers.
+CACHE_TTL = 7 * 24 * 3600
+GRID_SELECTOR = "[data-testid='product-grid']"
+CARD_SELECTOR = f"{GRID_SELECTOR} [data-testid='product-card']"
+TITLE_SELECTOR = "[data-testid='product-card-title']::text"
+PRICE_SELECTOR = "[data-testid='product-card-price']::text"
+BADGE_SELECTOR = "[data-testid='product-card-badge']::text"
+DISCOUNT_SELECTOR = "[data-testid='product-card-discount']::text"
+LINK_SELECTOR = "a::attr(href)"
+CSV_FIELDS = ("title", "price", "discount", "url", "scraped_at")
+MAX_FETCH_WORKERS = 8
+RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+MAX_RETRY_DELAY = 60.0
+BLOCKED_RESOURCE_TYPES = frozenset({"image", "font", "media", "stylesheet"})
+# httpx 0.26 added ``proxy=`` and 0.28 removed ``proxies=``; resolve once at import.
+_PROXY_KWARG = "proxies" if "proxies" in inspect.signature(httpx.Client).parameters else "proxy"
+_PRICE_TABLE = str.maketrans("", "", "$,")
+DEFAULT_USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+    "AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/122.0.0.0 Safari/537.36"
+)
+
+
+def compile_css(query: str) -> etree.XPath:
+    """Translate a parsel CSS query (``::text``/``::attr`` included) to a compiled XPath."""
+    return etree.XPath(css2xpath(query), smart_strings=False)
+
+
+_TITLE_TEXT = compile_css(TITLE_SELECTOR)
+_PRICE_TEXT = compile_css(PRICE_SELECTOR)
+_BADGE_TEXT = compile_css(BADGE_SELECTOR)
+_DISCOUNT_TEXT = compile_css(DISCOUNT_SELECTOR)
+_LINK_HREF = compile_css(LINK_SELECTOR)
+
+
+@dataclass(frozen=True, slots=True)
+class Deal:
+    title: str
+    price: str
+    discount: str
+    url: str
+    scraped_at: str
 
 
 def normalize_price(raw_price: str) -> float | None:
-    cleaned = raw_price.replace("$", "").replace(",", "").strip()
-    if not cleaned:
-        return None
     try:
-        return float(cleaned)
+        return float(raw_price.translate(_PRICE_TABLE))
     except ValueError:
         return None
 
@@ -36,6 +91,24 @@ def build_url(store_id: str | None) -> str:
     return CLEARANCE_URL
 
 
+def retry_after_seconds(response: httpx.Response) -> float | None:
+    """Parse a ``Retry-After`` header given either as seconds or as an HTTP date."""
+    value = response.headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
 def fetch_with_retries(
     client: httpx.Client, url: str, retries: int, backoff: float
 ) -> httpx.Response:
@@ -45,133 +118,333 @@ def fetch_with_retries(
             response = client.get(url)
             response.raise_for_status()
             return response
-        except httpx.TimeoutException:
+        except (httpx.TimeoutException, httpx.HTTPStatusError) as exc:
+            delay: float | None = None
+            if isinstance(exc, httpx.HTTPStatusError):
+                if exc.response.status_code not in RETRY_STATUS_CODES:
+                    raise
+                delay = retry_after_seconds(exc.response)
             attempt += 1
             if attempt > retries:
                 raise
-            time.sleep(backoff * attempt)
-
-
-def scrape_deals(
-    url: str,
-    user_agent: str | None = None,
-    proxy: str | None = None,
-    timeout: float = 30.0,
-    retries: int = 2,
-    backoff: float = 2.0,
-) -> list[dict[str, str]]:
-    results: list[dict[str, str]] = []
-    ua = user_agent or (
-        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-        "AppleWebKit/537.36 (KHTML, like Gecko) "
-        "Chrome/122.0.0.0 Safari/537.36"
-    )
-    headers = {
-        "user-agent": ua,
-        "accept": (
-            "text/html,application/xhtml+xml,application/xml;q=0.9,"
-            "image/avif,image/webp,*/*;q=0.8"
-        ),
-        "accept-language": "fr-CA,fr;q=0.9,en;q=0.8",
-    }
-    client_kwargs: dict[str, object] = {
-        "headers": headers,
-        "follow_redirects": True,
-        "timeout": timeout,
-    }
-    if proxy:
-        proxy_config = {"http://": proxy, "https://": proxy}
-        client_signature = inspect.signature(httpx.Client)
-        if "proxies" in client_signature.parameters:
-            client_kwargs["proxies"] = proxy_config
-        elif "proxy" in client_signature.parameters:
-            client_kwargs["proxy"] = proxy
-    with httpx.Client(**client_kwargs) as client:
-        response = fetch_with_retries(client, url, retries=retries, backoff=backoff)
-        selector = Selector(response.text)
-
-    cards = selector.css("[data-testid='product-grid'] [data-testid='product-card']")
-    scraped_at = datetime.now(timezone.utc).isoformat()
+            if delay is None:
+                # Exponential backoff with jitter so parallel store fetches spread out.
+                delay = min(MAX_RETRY_DELAY, backoff * 2 ** (attempt - 1)) + random.uniform(0, backoff)
+            elif delay > MAX_RETRY_DELAY:
+                raise
+            time.sleep(delay)
+
+
+def absolute_url(url_path: str) -> str:
+    return url_path if url_path.startswith("http") else f"{BASE_URL}{url_path}"
+
+
+def find_products(node: object) -> list[dict[str, object]] | None:
+    """Return the shallowest non-empty ``products`` list of objects in a JSON tree.
+
+    The tree is walked breadth-first in document order, so the main listing
+    wins over deeper or later lists such as recently-viewed carousels.
+    """
+    queue = deque([node])
+    while queue:
+        current = queue.popleft()
+        if isinstance(current, dict):
+            products = current.get("products")
+            if isinstance(products, list) and products and isinstance(products[0], dict):
+                return products
+            queue.extend(current.values())
+        elif isinstance(current, list):
+            queue.extend(current)
+    return None
+
+
+def json_price_text(value: object) -> str:
+    if isinstance(value, dict):
+        value = value.get("formattedValue") or value.get("value")
+    if isinstance(value, (int, float)):
+        return f"${value:.2f}"
+    return str(value or "").strip()
+
+
+def next_data_products(selector: Selector) -> list[dict[str, object]] | None:
+    """Return the product list from the embedded ``__NEXT_DATA__`` blob, if any."""
+    raw = selector.css("script#__NEXT_DATA__::text").get()
+    if not raw:
+        return None
+    try:
+        return find_products(orjson.loads(raw))
+    except orjson.JSONDecodeError:
+        return None
+
+
+def parse_next_data(products: Iterable[dict[str, object]], scraped_at: str) -> Iterator[Deal]:
+    for product in products:
+        url_path = product.get("url") or product.get("canonicalUrl")
+        if not isinstance(url_path, str) or not url_path:
+            continue
+        yield Deal(
+            title=str(product.get("name") or product.get("title") or "").strip(),
+            price=json_price_text(product.get("price")),
+            discount=str(product.get("discount") or product.get("badge") or "").strip(),
+            url=absolute_url(url_path),
+            scraped_at=scraped_at,
+        )
+
+
+def parse_cards(cards: SelectorList, scraped_at: str) -> Iterator[Deal]:
     for card in cards:
-        title = " ".join(card.css("[data-testid='product-card-title']::text").getall()).strip()
-        price_text = " ".join(card.css("[data-testid='product-card-price']::text").getall()).strip()
-        discount = " ".join(card.css("[data-testid='product-card-badge']::text").getall()).strip()
-        if not discount:
-            discount = " ".join(card.css("[data-testid='product-card-discount']::text").getall()).strip()
-        url_path = card.css("a::attr(href)").get()
-        if not url_path:
+        root = card.root
+        hrefs = _LINK_HREF(root)
+        if not hrefs or not hrefs[0]:
             continue
-        full_url = url_path if url_path.startswith("http") else f"{BASE_URL}{url_path}"
-        results.append(
-            {
-                "title": title,
-                "price": price_text,
-                "discount": discount,
-                "url": full_url,
-                "scraped_at": scraped_at,
-            }
+        url_path = hrefs[0]
+        title = " ".join(_TITLE_TEXT(root)).strip()
+        price_text = " ".join(_PRICE_TEXT(root)).strip()
+        discount = " ".join(_BADGE_TEXT(root)).strip()
+        if not discount:
+            discount = " ".join(_DISCOUNT_TEXT(root)).strip()
+        yield Deal(
+            title=title,
+            price=price_text,
+            discount=discount,
+            url=absolute_url(url_path),
+            scraped_at=scraped_at,
         )
 
-    return results
 
+def block_heavy_resources(route: Route) -> None:
+    """Abort requests the scraper never reads, so pages render from HTML and JS only."""
+    if route.request.resource_type in BLOCKED_RESOURCE_TYPES:
+        route.abort()
+    else:
+        route.continue_()
 
-def filter_penny_deals(results: Iterable[dict[str, str]], max_price: float = 5.00) -> list[dict[str, str]]:
-    penny_deals: list[dict[str, str]] = []
-    for deal in results:
-        price_value = normalize_price(deal.get("price", ""))
-        if price_value is None:
-            continue
-        if price_value < max_price:
-            penny_deals.append(deal)
-    return penny_deals
+
+class HomeDepotScraper:
+    """Scrape listing pages with one httpx client and at most one browser.
+
+    Chromium is only launched the first time a page needs rendering, then kept
+    alive for every later URL; each render gets its own short-lived context.
+    Playwright is imported lazily so it stays optional for the httpx fast path.
+    """
+
+    def __init__(
+        self,
+        user_agent: str | None = None,
+        proxy: str | None = None,
+        timeout: float = 30.0,
+        retries: int = 2,
+        backoff: float = 2.0,
+    ) -> None:
+        self.user_agent = user_agent or DEFAULT_USER_AGENT
+        self.proxy = proxy
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._client: httpx.Client | None = None
+        self._playwright: Playwright | None = None
+        self._browser: Browser | None = None
+
+    def __enter__(self) -> HomeDepotScraper:
+        self._client = SyncCacheClient(
+            storage=SyncSqliteStorage(database_path=CACHE_PATH, default_ttl=CACHE_TTL),
+            policy=SpecificationPolicy(),
+            **self._client_kwargs(),
+        )
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        if self._browser is not None:
+            self._browser.close()
+            self._browser = None
+        if self._playwright is not None:
+            self._playwright.stop()
+            self._playwright = None
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    def _client_kwargs(self) -> dict[str, object]:
+        headers = {
+            "user-agent": self.user_agent,
+            "accept": (
+                "text/html,application/xhtml+xml,application/xml;q=0.9,"
+                "image/avif,image/webp,*/*;q=0.8"
+            ),
+            "accept-language": "fr-CA,fr;q=0.9,en;q=0.8",
+            # accept-encoding is left to httpx, which only advertises br/zstd when
+            # the brotli/zstandard decoders are installed.
+        }
+        client_kwargs: dict[str, object] = {
+            "headers": headers,
+            "follow_redirects": True,
+            "timeout": self.timeout,
+            "http2": True,
+            "limits": httpx.Limits(max_connections=16, max_keepalive_connections=16),
+        }
+        if self.proxy:
+            if _PROXY_KWARG == "proxies":
+                client_kwargs["proxies"] = {"http://": self.proxy, "https://": self.proxy}
+            else:
+                client_kwargs["proxy"] = self.proxy
+        return client_kwargs
+
+    def _get_browser(self) -> Browser:
+        if self._browser is None:
+            from playwright.sync_api import sync_playwright
+
+            launch_kwargs: dict[str, object] = {"headless": True}
+            if self.proxy:
+                launch_kwargs["proxy"] = {"server": self.proxy}
+            self._playwright = sync_playwright().start()
+            self._browser = self._playwright.chromium.launch(**launch_kwargs)
+        return self._browser
+
+    def render(self, url: str) -> str:
+        """Render ``url`` in a fresh browser context and return the product grid HTML.
+
+        Returns an empty string when Playwright is not installed or no card shows
+        up within the timeout, since a store without clearance items is valid.
+        """
+        try:
+            from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
+        except ImportError:
+            print(f"Playwright is not installed; treating {url} as having no cards.", file=sys.stderr)
+            return ""
+        context = self._get_browser().new_context(user_agent=self.user_agent, locale="fr-CA")
+        try:
+            page = context.new_page()
+            page.route("**/*", block_heavy_resources)
+            page.goto(url, wait_until="domcontentloaded", timeout=self.timeout * 1000)
+            try:
+                page.locator(CARD_SELECTOR).first.wait_for(state="attached", timeout=self.timeout * 1000)
+            except PlaywrightTimeoutError:
+                return ""
+            # One in-page DOM walk instead of serializing the whole document.
+            return page.evaluate(
+                "sel => Array.from(document.querySelectorAll(sel), el => el.outerHTML).join('')",
+                GRID_SELECTOR,
+            )
+        finally:
+            context.close()
+
+    def fetch(self, url: str) -> Selector:
+        """Download and parse ``url``; safe to call from several threads at once."""
+        if self._client is None:
+            raise RuntimeError("HomeDepotScraper must be used as a context manager.")
+        response = fetch_with_retries(self._client, url, retries=self.retries, backoff=self.backoff)
+        return Selector(response.text)
+
+    def extract(self, url: str, selector: Selector) -> Iterator[Deal]:
+        """Yield deals from a fetched page, rendering it if the grid is missing.
+
+        Playwright's sync API is bound to the thread that started it, so this
+        must run on the thread that owns the scraper.
+        """
+        scraped_at = datetime.now(timezone.utc).isoformat()
+        products = next_data_products(selector)
+        if products:
+            found = False
+            for deal in parse_next_data(products, scraped_at):
+                found = True
+                yield deal
+            if found:
+                return
+        cards = selector.css(CARD_SELECTOR)
+        if not cards:
+            # The grid is rendered client-side on some pages; retry in a browser.
+            cards = Selector(self.render(url)).css(CARD_SELECTOR)
+        yield from parse_cards(cards, scraped_at)
+
+    def scrape(self, url: str) -> Iterator[Deal]:
+        yield from self.extract(url, self.fetch(url))
+
+
+def is_penny_deal(deal: Deal, max_price: float = 5.00) -> bool:
+    return (price_value := normalize_price(deal.price)) is not None and price_value < max_price
 
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Scrape Home Depot liquidation deals.")
     parser.add_argument("--store", help="Optional store ID to filter results.")
+    parser.add_argument("--stores", help="Comma-separated store IDs to scrape in parallel.")
     parser.add_argument("--user-agent", help="Custom user agent string.")
     parser.add_argument("--proxy", help="Proxy server, e.g. http://proxy:port.")
     parser.add_argument("--timeout", type=float, default=30.0, help="Request timeout in seconds.")
-    parser.add_argument("--retries", type=int, default=2, help="Retry count on timeouts.")
-    parser.add_argument("--backoff", type=float, default=2.0, help="Backoff multiplier in seconds.")
-    parser.add_argument("--output", default=str(OUTPUT_PATH), help="Output JSON path.")
-    return parser.parse_args()
+    parser.add_argument("--retries", type=int, default=2, help="Retry count on timeouts and 429/5xx responses.")
+    parser.add_argument("--backoff", type=float, default=2.0, help="Base backoff in seconds, doubled per retry.")
+    parser.add_argument(
+        "--output",
+        default=str(OUTPUT_PATH),
+        help="Output NDJSON path; CSV and _meta.json files are written beside it.",
+    )
+    args = parser.parse_args()
+    if Path(args.output).suffix != ".ndjson":
+        parser.error("--output must end in .ndjson")
+    return args
 
 
 def main() -> None:
     args = parse_args()
-    source_url = build_url(args.store)
-    results = scrape_deals(
-        source_url,
-        args.user_agent,
-        args.proxy,
-        timeout=args.timeout,
-        retries=args.retries,
-        backoff=args.backoff,
-    )
-    penny_deals = filter_penny_deals(results)
+    store_ids = [args.store] if args.store else []
+    if args.stores:
+        store_ids.extend(store_id.strip() for store_id in args.stores.split(",") if store_id.strip())
+    source_urls = [build_url(store_id) for store_id in store_ids] or [build_url(None)]
 
     output_path = Path(args.output)
     output_path.parent.mkdir(parents=True, exist_ok=True)
     csv_path = output_path.with_suffix(".csv")
+    meta_path = output_path.with_name(f"{output_path.stem}_meta.json")
+    # Stream into temp files and only replace the previous outputs once the
+    # whole scrape has succeeded; meta goes last so it never describes stale data.
+    final_paths = (output_path, csv_path, meta_path)
+    tmp_paths = {path: path.with_name(f".{path.name}.tmp") for path in final_paths}
+
+    deal_count = 0
+    penny_indices: list[int] = []
+    try:
+        with (
+            HomeDepotScraper(
+                args.user_agent,
+                args.proxy,
+                timeout=args.timeout,
+                retries=args.retries,
+                backoff=args.backoff,
+            ) as scraper,
+            tmp_paths[output_path].open("wb") as ndjson_handle,
+            tmp_paths[csv_path].open("w", newline="", encoding="utf-8", buffering=1 << 20) as csv_handle,
+            ThreadPoolExecutor(max_workers=min(MAX_FETCH_WORKERS, len(source_urls))) as executor,
+        ):
+            writer = csv.writer(csv_handle)
+            writer.writerow(CSV_FIELDS)
+            # Pages download concurrently; extraction stays on this thread for Playwright.
+            for source_url, selector in zip(source_urls, executor.map(scraper.fetch, source_urls)):
+                for deal in scraper.extract(source_url, selector):
+                    ndjson_handle.write(orjson.dumps(deal) + b"\n")
+                    writer.writerow((deal.title, deal.price, deal.discount, deal.url, deal.scraped_at))
+                    if is_penny_deal(deal):
+                        penny_indices.append(deal_count)
+                    deal_count += 1
+
+        meta = {
+            "scraped_at": datetime.now(timezone.utc),
+            "source_urls": source_urls,
+            "deal_count": deal_count,
+            "penny_deal_count": len(penny_indices),
+            "penny_deal_indices": penny_indices,
+        }
+        tmp_paths[meta_path].write_bytes(orjson.dumps(meta, option=orjson.OPT_INDENT_2))
+    except BaseException:
+        for tmp_path in tmp_paths.values():
+            tmp_path.unlink(missing_ok=True)
+        raise
 
-    payload = {
-        "scraped_at": datetime.now(timezone.utc).isoformat(),
-        "source_url": source_url,
-        "deal_count": len(results),
-        "penny_deal_count": len(penny_deals),
-        "deals": results,
-        "penny_deals": penny_deals,
-    }
-
-    output_path.write_text(json.dumps(payload, indent=2, ensure_ascii=False))
-    with csv_path.open("w", newline="", encoding="utf-8") as handle:
-        writer = csv.DictWriter(handle, fieldnames=["title", "price", "discount", "url", "scraped_at"])
-        writer.writeheader()
-        writer.writerows(results)
+    for path in final_paths:
+        os.replace(tmp_paths[path], path)
 
     print(
-        f"Saved {len(results)} deals ({len(penny_deals)} penny deals) to {output_path} and {csv_path}"
+        f"Saved {deal_count} deals ({len(penny_indices)} penny deals) "
+        f"to {output_path}, {csv_path} and {meta_path}"
     )
 
 